@@ -2,14 +2,26 @@ import streamlit as st
 import pandas as pd
 import pikepdf
 import pdfplumber
-import os
-import tempfile
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
 import re
+import io
+import hashlib
 import sqlite3
-from datetime import datetime
+import queue
+import threading
+import time
+import atexit
+import logging
 
 import plotly.express as px
-from transformers import pipeline
+from pdfminer.psparser import PSException
+from pdfminer.pdfdocument import PDFPasswordIncorrect
+
+try:
+    from pdfplumber.utils.exceptions import PdfminerException
+except ImportError:  # older pdfplumber lets pdfminer errors through unwrapped
+    PdfminerException = PSException
 
 # ---------------------------
 # SQLite DB Setup
@@ -17,108 +29,213 @@ from transformers import pipeline
 
 DB_FILE = "phonepe_finance.db"
 
+NAME_MAP_FLUSH_SECONDS = 0.25
+NAME_MAP_BATCH_SIZE = 100
+NAME_MAP_WRITE_ATTEMPTS = 3
+NAME_MAP_RETRY_SECONDS = 0.5
+
+logger = logging.getLogger(__name__)
+
+@st.cache_resource
 def get_db_connection():
+    # One long-lived connection shared across reruns instead of reconnecting on every call
     conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    # Pragmas are per-connection, so they are applied once here and persist with it.
+    # WAL + synchronous=NORMAL avoids an fsync per commit; fine for this single-process app.
+    conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-32768;
+        PRAGMA mmap_size=268435456;
+    ''')
     return conn
 
+@st.cache_resource
+def get_db_lock():
+    # Serializes use of the shared connection between the app and the writer thread
+    return threading.Lock()
+
 def init_db():
     conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS name_category_map (
-            name TEXT PRIMARY KEY,
-            category TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    with get_db_lock():
+        c = conn.cursor()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS name_category_map (
+                name TEXT PRIMARY KEY,
+                category TEXT
+            )
+        ''')
+        conn.commit()
 
 def load_name_category_map():
     conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT name, category FROM name_category_map')
-    rows = c.fetchall()
-    conn.close()
+    with get_db_lock():
+        c = conn.cursor()
+        c.execute('SELECT name, category FROM name_category_map')
+        rows = c.fetchall()
     return {name: category for name, category in rows}
 
-def save_name_category_map(name_category_dict):
-    conn = get_db_connection()
-    c = conn.cursor()
-    for name, category in name_category_dict.items():
-        c.execute('''
+def write_name_category_map(conn, lock, name_category_dict):
+    # Single transaction for the whole batch
+    with lock, conn:
+        conn.executemany('''
             INSERT INTO name_category_map (name, category) 
             VALUES (?, ?) 
             ON CONFLICT(name) DO UPDATE SET category=excluded.category
-        ''', (name, category))
-    conn.commit()
-    conn.close()
+        ''', name_category_dict.items())
+
+def _drain_name_category_queue(pending, conn, lock):
+    # Coalesce queued (name, category) pairs into one write per interval or batch.
+    # Runs outside Streamlit's script thread, so it is handed the shared cached
+    # connection and its lock rather than calling the st.cache_resource getters itself.
+    while True:
+        batch = [pending.get()]
+        deadline = time.monotonic() + NAME_MAP_FLUSH_SECONDS
+        while len(batch) < NAME_MAP_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        updates = dict(batch)
+        try:
+            for attempt in range(1, NAME_MAP_WRITE_ATTEMPTS + 1):
+                try:
+                    write_name_category_map(conn, lock, updates)
+                    break
+                except sqlite3.Error:
+                    if attempt == NAME_MAP_WRITE_ATTEMPTS:
+                        logger.exception("Dropping %d learned name categories after %d attempts: %r",
+                                         len(updates), attempt, updates)
+                    else:
+                        logger.warning("Saving name categories failed (attempt %d), retrying", attempt)
+                        time.sleep(NAME_MAP_RETRY_SECONDS * attempt)
+        finally:
+            for _ in batch:
+                pending.task_done()
+
+@st.cache_resource
+def get_name_category_queue():
+    pending = queue.Queue()
+    threading.Thread(
+        target=_drain_name_category_queue,
+        args=(pending, get_db_connection(), get_db_lock()),
+        daemon=True
+    ).start()
+    # Flush anything still queued when the server shuts down
+    atexit.register(pending.join)
+    return pending
+
+def queue_name_category_updates(name_category_pairs):
+    # Write-behind: persisting happens on the writer thread, not in the Streamlit rerun
+    pending = get_name_category_queue()
+    for pair in name_category_pairs:
+        pending.put(pair)
 
 # ---------------------------
 # PDF Utility
 # ---------------------------
-def remove_pdf_password(input_path, output_path, password):
-    try:
-        with pikepdf.open(input_path, password=password) as pdf:
-            pdf.save(output_path)
-        return output_path
-    except Exception:
-        st.error("❌ Failed to remove PDF password. Try again.")
-        return None
+def unlock_pdf_in_memory(pdf_source, password):
+    # Fallback for encrypted PDFs pdfium rejects; decrypts into memory, not to disk
+    buffer = io.BytesIO()
+    if isinstance(pdf_source, bytes):
+        pdf_source = io.BytesIO(pdf_source)
+    with pikepdf.open(pdf_source, password=password) as pdf:
+        pdf.save(buffer)
+    return buffer.getvalue()
 
 # ---------------------------
 # PhonePe Parser
 # ---------------------------
-def parse_phonepe_pdf(pdf_path):
-    transactions = []
-
-    def is_transaction_line(line):
-        return re.match(r'^[A-Za-z]{3} \d{2}, \d{4} .* (Debit|Credit) INR \d', line)
-
-    with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            text = page.extract_text()
-            if not text:
-                continue
-            lines = text.split("\n")
-            for line in lines:
-                if is_transaction_line(line):
-                    transactions.append(line)
-
-    parsed_rows = []
-    for line in transactions:
-        try:
-            # Extract date
-            date_match = re.search(r'^([A-Za-z]{3} \d{2}, \d{4})', line)
-            date_str = date_match.group(1)
-            date = datetime.strptime(date_str, "%b %d, %Y").date()
-
-            # Extract name
-            if "Paid to" in line:
-                name = line.split("Paid to")[1].split("Debit")[0].strip()
-            elif "Received from" in line:
-                name = line.split("Received from")[1].split("Credit")[0].strip()
-            else:
-                name = "Unknown"
-
-            # Extract type
-            txn_type = "Debit" if "Debit" in line else "Credit"
-
-            # Extract amount
-            amount_match = re.search(r'INR ([\d,]+\.\d{2})', line)
-            amount = float(amount_match.group(1).replace(",", "")) if amount_match else 0.0
-
-            parsed_rows.append({
-                "Date": date,
-                "Name": name,
-                "Debit/Credit": txn_type,
-                "Amount": amount
-            })
-
-        except Exception as e:
-            print("Error parsing line:", line)
-            continue
+# Column-wise extraction of date, name, type and amount; non-transaction lines don't match
+_TXN_FIELDS = re.compile(
+    r'^(?P<Date>[A-Za-z]{3} \d{2}, \d{4}) '
+    r'(?:.*?(?:Paid to|Received from)\s*(?P<Name>.*?)\s+|.*? )'
+    r'(?P<Type>Debit|Credit) INR (?P<Amount>[\d,]+\.\d{2})'
+)
+
+def extract_pdf_text_pdfium(pdf_source, password=None):
+    texts = []
+    pdf = pdfium.PdfDocument(pdf_source, password=password)
+    try:
+        for page in pdf:
+            tp = page.get_textpage()
+            texts.append(tp.get_text_range())
+            tp.close()
+            page.close()
+    finally:
+        pdf.close()
+    return texts
+
+def extract_pdf_text_pdfplumber(pdf_source, password=None):
+    if isinstance(pdf_source, bytes):
+        pdf_source = io.BytesIO(pdf_source)
+    with pdfplumber.open(pdf_source, password=password) as pdf:
+        return [page.extract_text() for page in pdf.pages]
+
+def extract_transaction_fields(page_texts):
+    # One regex pass per line: lines that aren't transactions come back all-NaN and are dropped
+    lines = pd.Series([line for text in page_texts if text for line in text.splitlines()], dtype=object)
+    return lines.str.extract(_TXN_FIELDS).dropna(subset=["Date"])
+
+def parse_phonepe_pdf(pdf_source, password=None):
+    # pypdfium2 is much faster for plain text
+    try:
+        page_texts = extract_pdf_text_pdfium(pdf_source, password)
+    except pdfium.PdfiumError:
+        if not password:
+            raise
+        pdf_source, password = unlock_pdf_in_memory(pdf_source, password), None
+        page_texts = extract_pdf_text_pdfium(pdf_source)
+    fields = extract_transaction_fields(page_texts)
+
+    # pdfium keeps content-stream order; pdfplumber rebuilds lines by position, which
+    # table-style statements need, so retry with it when no transaction lines matched
+    if fields.empty:
+        fields = extract_transaction_fields(extract_pdf_text_pdfplumber(pdf_source, password))
+
+    if fields.empty:
+        return pd.DataFrame()
+
+    df = pd.DataFrame({
+        "Date": pd.to_datetime(fields["Date"], format="%b %d, %Y", errors="coerce").dt.date,
+        "Name": fields["Name"].fillna("Unknown"),
+        "Debit/Credit": fields["Type"],
+        "Amount": fields["Amount"].str.replace(",", "", regex=False).astype(float)
+    })
+    df = df.dropna(subset=["Date"]).reset_index(drop=True)
+    return add_name_key(df)
+
+def add_name_key(df):
+    # Normalized merchant name used for all category lookups
+    df["_name_key"] = df["Name"].str.lower().str.strip()
+    return df
 
-    return pd.DataFrame(parsed_rows)
+def is_pdf_password_error(error):
+    if isinstance(error, pikepdf.PasswordError):
+        return True
+    if isinstance(error, pdfium.PdfiumError):
+        return getattr(error, "err_code", None) == pdfium_c.FPDF_ERR_PASSWORD
+    # pdfplumber wraps the original pdfminer error as the first argument
+    if isinstance(error, PdfminerException) and error.args and isinstance(error.args[0], BaseException):
+        error = error.args[0]
+    return isinstance(error, PDFPasswordIncorrect)
+
+@st.cache_data(show_spinner="Parsing statement...", max_entries=8, ttl=3600)
+def load_pdf_transactions(file_key, _file_bytes, password):
+    # Cached on the file hash and password so reruns skip parsing;
+    # the upload is parsed straight from memory without a temp file
+    try:
+        return parse_phonepe_pdf(_file_bytes, password or None)
+    except (pdfium.PdfiumError, pikepdf.PdfError, PdfminerException, PSException) as e:
+        if is_pdf_password_error(e):
+            st.error("❌ Failed to unlock PDF. Check the password and try again.")
+        else:
+            st.error("❌ Could not read PDF. Check that the file is a valid PhonePe statement.")
+        return None
 
 # ---------------------------
 # Category Defaults
@@ -138,52 +255,210 @@ default_keywords = {
 # ---------------------------
 # Categorization
 # ---------------------------
-def categorize_transactions(df, keyword_dict, name_map):
-    categories = []
-    for name in df["Name"]:
-        name_lower = name.lower().strip()
-        if name_lower in name_map:
-            categories.append(name_map[name_lower])
-            continue
-
-        matched = False
-        for category, keywords in keyword_dict.items():
-            if any(keyword.lower() in name_lower for keyword in keywords):
-                categories.append(category)
-                matched = True
-                break
-        if not matched:
-            categories.append("Other")
-    df["Category"] = categories
+def build_keyword_index(keyword_dict):
+    # Reverse index keyword -> category; the first category listing a keyword wins
+    kw_to_cat = {}
+    for category, keywords in keyword_dict.items():
+        for keyword in keywords:
+            if keyword:
+                kw_to_cat.setdefault(keyword.lower(), category)
+    return kw_to_cat
+
+@st.cache_resource(max_entries=8)
+def compile_category_patterns(keyword_items):
+    # One compiled alternation per category instead of per-keyword substring scans,
+    # in category order so the first matching category wins as before
+    by_category = {}
+    for keyword, category in keyword_items:
+        by_category.setdefault(category, []).append(keyword)
+    return [
+        (category, re.compile("|".join(re.escape(k) for k in keywords)))
+        for category, keywords in by_category.items()
+    ]
+
+def categorize_transactions(df, kw_to_cat, name_map):
+    names = df["_name_key"]
+    # Classify each distinct name once, then broadcast back to every row
+    unique_names = pd.Series(names.unique(), dtype=object)
+    keyword_hits = pd.Series(None, index=unique_names.index, dtype=object)
+    for category, pattern in compile_category_patterns(tuple(kw_to_cat.items())):
+        candidates = unique_names[keyword_hits.isna()]
+        if candidates.empty:
+            break
+        matched = candidates.str.contains(pattern, na=False)
+        keyword_hits.loc[matched[matched].index] = category
+    unique_cats = unique_names.map(name_map).fillna(keyword_hits).fillna("Other")
+    df["Category"] = names.map(dict(zip(unique_names, unique_cats))).fillna("Other")
     return df
 
+# ---------------------------
+# CSV Export
+# ---------------------------
+def frame_content_key(df):
+    # Order-sensitive hash of the rows plus the column names
+    digest = hashlib.blake2b(pd.util.hash_pandas_object(df).to_numpy().tobytes(), digest_size=16)
+    digest.update(repr(tuple(df.columns)).encode())
+    return digest.hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def export_csv_bytes(df_key, _df):
+    # Keyed on the frame's content hash so reruns don't re-stringify every cell
+    buffer = io.BytesIO()
+    _df.drop(columns="_name_key", errors="ignore").to_csv(buffer, index=False)
+    return buffer.getvalue()
+
 # ---------------------------
 # Hugging Face Chatbot Functions
 # ---------------------------
 
 @st.cache_resource
 def load_hf_pipelines():
+    # Imported here so the app starts without loading transformers/torch
+    from transformers import pipeline
     qa = pipeline("question-answering", model="distilbert-base-cased-distilled-squad")
     return qa
 
-def answer_nlp_question(df, question):
-    # Rule-based for common finance questions
-    question_lower = question.lower()
-    if ("total" in question_lower or "how much" in question_lower) and "spend" in question_lower:
-        for cat in df["Category"].unique():
-            if cat.lower() in question_lower:
-                total = df[df["Category"] == cat]["Amount"].sum()
-                return f"Total spent on {cat}: INR {total:.2f}"
+def get_category_index(df):
+    # Lowercase category -> (original, whole-word pattern), rebuilt only when categories change.
+    # The chatbot frame is categorical, so its category list is the cheap cache key.
+    if isinstance(df["Category"].dtype, pd.CategoricalDtype):
+        categories = df["Category"].cat.categories
+    else:
+        categories = df["Category"].dropna().unique()
+    key = tuple(categories)
+    cached = st.session_state.get("category_index")
+    if cached is None or cached[0] != key:
+        categories = sorted(categories, key=lambda cat: len(str(cat)), reverse=True)
+        index = {
+            str(cat).lower(): (cat, re.compile(r'(?<!\w)' + re.escape(str(cat).lower()) + r'(?!\w)'))
+            for cat in categories
+        }
+        cached = (key, index)
+        st.session_state.category_index = cached
+    return cached[1]
+
+def find_category_in_question(category_index, question_lower):
+    for cat, cat_pattern in category_index.values():
+        if cat_pattern.search(question_lower):
+            return cat
+    return None
+
+QA_STOPWORDS = {
+    "a", "all", "an", "and", "are", "at", "did", "do", "each", "every", "for", "from", "how",
+    "i", "in", "is", "last", "me", "much", "my", "of", "on", "show", "the", "this", "to",
+    "was", "what", "when", "where", "which", "who", "with",
+}
+
+def has_word(question_lower, *words):
+    return any(re.search(r'\b' + re.escape(w) + r'\b', question_lower) for w in words)
+
+def find_merchant_terms(df, question_lower, category_index, category):
+    # Words right after "pay/paid/to/at/from/on/for" name a merchant; returns (known, unknown)
+    if category:
+        question_lower = category_index[str(category).lower()][1].sub(" ", question_lower)
+    refs = re.findall(r'\b(?:pay|paid|to|at|from|on|for)\s+(\w+)', question_lower)
+    keywords = st.session_state.get("keyword_to_category", {})
+    known, unknown = [], []
+    for term in dict.fromkeys(refs):
+        if term in QA_STOPWORDS or term.isdigit():
+            continue
+        if term in keywords or merchant_mask(df, term).any():
+            known.append(term)
+        else:
+            unknown.append(term)
+    return known, unknown
+
+def merchant_mask(df, term):
+    # Whole-token match so "ola" doesn't hit "coca cola"; rows without a name never match
+    return df["_name_key"].str.contains(r'\b' + re.escape(term) + r'\b', regex=True, na=False)
+
+def answer_rule_based(df, question_lower):
+    category_index = get_category_index(df)
+    category = find_category_in_question(category_index, question_lower)
+    merchant_terms, unknown_terms = find_merchant_terms(df, question_lower, category_index, category)
+    if unknown_terms and not (category or merchant_terms):
+        # The question names a merchant we can't scope to; let the QA model handle it
+        return None
+
+    scoped = df[df["Category"].to_numpy() == category] if category else df
+    for term in merchant_terms:
+        scoped = scoped[merchant_mask(scoped, term)]
+    subject = category or " ".join(merchant_terms)
+    label = f" on {subject}" if subject else ""
+
+    if (has_word(question_lower, "total") or "how much" in question_lower) and has_word(question_lower, "spend", "spent"):
+        if subject:
+            total = scoped["Amount"].sum()
+            return f"Total spent on {subject}: INR {total:.2f}"
         # Try for all expenses
-        if "total" in question_lower and ("expense" in question_lower or "spend" in question_lower):
+        if has_word(question_lower, "total") and has_word(question_lower, "expense", "expenses", "spend", "spent"):
             total = df["Amount"].sum()
             return f"Total spent: INR {total:.2f}"
+
+    # Top N merchants by amount ("top-up" / "top up" is not a request for a ranking)
+    top_match = re.search(r'\btop\b(?!\s*-?\s*up\b)\s*(\d+)?', question_lower)
+    if top_match and has_word(question_lower, "merchant", "merchants", "payee", "payees", "shop", "shops",
+                              "store", "stores", "spend", "spent", "paid"):
+        n = int(top_match.group(1) or 5)
+        top = scoped.groupby("Name")["Amount"].sum().nlargest(n)
+        if top.empty:
+            return f"No transactions found{label}."
+        lines = [f"{i}. {name}: INR {amount:.2f}" for i, (name, amount) in enumerate(top.items(), 1)]
+        return f"Top {len(top)} merchants{label}:\n" + "\n".join(lines)
+
+    # This month vs last month (relative to the latest month in the statement)
+    if "this month" in question_lower and "last month" in question_lower:
+        months = pd.to_datetime(scoped["Date"]).dt.to_period("M")
+        if months.empty:
+            return f"No transactions found{label}."
+        monthly = scoped["Amount"].groupby(months).sum()
+        this_month = months.max()
+        this_total = monthly.get(this_month, 0.0)
+        last_total = monthly.get(this_month - 1, 0.0)
+        return (f"Spent{label} in {this_month}: INR {this_total:.2f} "
+                f"vs {this_month - 1}: INR {last_total:.2f} "
+                f"(difference: INR {this_total - last_total:+.2f})")
+
+    # Average transaction amount
+    if has_word(question_lower, "average", "avg"):
+        if scoped.empty:
+            return f"No transactions found{label}."
+        return f"Average transaction{label}: INR {scoped['Amount'].mean():.2f}"
+
+    # Transaction count
+    if "how many" in question_lower or has_word(question_lower, "count") or "number of" in question_lower:
+        return f"Number of transactions{label}: {len(scoped)}"
+
+    return None
+
+QA_CONTEXT_CHARS = 1800
+
+@st.cache_data(show_spinner=False)
+def build_context_rows(df):
+    return ("On " + df["Date"].astype(str) + ", paid " + df["Amount"].astype(str)
+            + " INR to " + df["Name"].astype(str) + " in category " + df["Category"].astype(str) + ".")
+
+def build_qa_context(df, question_lower):
+    # Keep the rows most relevant to the question instead of the first N characters
+    rows = build_context_rows(df)
+    tokens = [t for t in re.findall(r'\w+', question_lower) if t not in QA_STOPWORDS]
+    if tokens:
+        rows_lower = rows.str.lower()
+        scores = sum(rows_lower.str.contains(t, regex=False).astype(int) for t in tokens)
+        if scores.any():
+            rows = rows.iloc[(-scores.to_numpy()).argsort(kind="stable")]
+    within_limit = (rows.str.len() + 1).cumsum() <= QA_CONTEXT_CHARS
+    return "\n".join(rows[within_limit])
+
+def answer_nlp_question(df, question):
+    # Rule-based for common finance questions
+    question_lower = question.lower()
+    answer = answer_rule_based(df, question_lower)
+    if answer is not None:
+        return answer
+
     # Fallback to QA model
-    context = ""
-    for _, row in df.iterrows():
-        context += f"On {row['Date']}, paid {row['Amount']} INR to {row['Name']} in category {row['Category']}.\n"
-    if len(context) > 1800:
-        context = context[:1800]
+    context = build_qa_context(df, question_lower)
     qa = load_hf_pipelines()
     result = qa(question=question, context=context)
     return result['answer']
@@ -206,7 +481,11 @@ def main():
             st.session_state.name_to_category = load_name_category_map()
 
         if "keyword_dict" not in st.session_state:
-            st.session_state.keyword_dict = default_keywords.copy()
+            # Per-session sets: O(1) membership, and learned words never leak into default_keywords
+            st.session_state.keyword_dict = {cat: set(words) for cat, words in default_keywords.items()}
+
+        if "keyword_to_category" not in st.session_state:
+            st.session_state.keyword_to_category = build_keyword_index(st.session_state.keyword_dict)
 
         file_ext = uploaded_file.name.split(".")[-1].lower()
         df = None
@@ -214,66 +493,81 @@ def main():
         if file_ext == "pdf":
             password = st.text_input("Enter PDF Password (if any)", type="password")
             if password or st.button("Load PDF without password"):
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_input:
-                    temp_input.write(uploaded_file.read())
-                    temp_input_path = temp_input.name
-
-                temp_output_path = temp_input_path.replace(".pdf", "_unlocked.pdf")
-                if password:
-                    unlocked_path = remove_pdf_password(temp_input_path, temp_output_path, password)
-                    if unlocked_path:
-                        df = parse_phonepe_pdf(unlocked_path)
-                else:
-                    df = parse_phonepe_pdf(temp_input_path)
+                file_bytes = uploaded_file.getvalue()
+                file_key = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+                df = load_pdf_transactions(file_key, file_bytes, password)
 
         elif file_ext == "csv":
             df = pd.read_csv(uploaded_file)
             if "Date" in df.columns:
                 df["Date"] = pd.to_datetime(df["Date"])
+            if "Name" in df.columns:
+                df = add_name_key(df)
 
         if df is not None and not df.empty:
             st.success("✅ Transactions Loaded")
             debits_df = df[df["Debit/Credit"] == "Debit"].copy()
 
             # Initial categorization
-            df = categorize_transactions(debits_df, st.session_state.keyword_dict, st.session_state.name_to_category)
+            df = categorize_transactions(debits_df, st.session_state.keyword_to_category, st.session_state.name_to_category)
             edited_df = df.copy()
 
             st.markdown("### ✏️ Categorize & Edit Transactions")
-            edited_df = st.data_editor(edited_df, num_rows="dynamic", use_container_width=True)
+            edited_df = st.data_editor(
+                edited_df,
+                num_rows="dynamic",
+                use_container_width=True,
+                column_config={"_name_key": None}
+            )
+            # Names may have been edited or rows added, so re-derive the key from the edited names
+            edited_df = add_name_key(edited_df)
 
             # Learn from user edits
-            changed = False
-            for i in range(len(edited_df)):
-                old_cat = df.iloc[i]["Category"]
-                new_cat = edited_df.iloc[i]["Category"]
-                name = edited_df.iloc[i]["Name"]
-
-                if new_cat != old_cat and new_cat.strip():
-                    changed = True
-
-                    # Add new category to keyword dict if missing
-                    if new_cat not in st.session_state.keyword_dict:
-                        st.session_state.keyword_dict[new_cat] = []
-
-                    # Learn from full name
-                    st.session_state.name_to_category[name.lower()] = new_cat
-
-                    # Add name tokens to keyword dict
-                    words = name.lower().split()
-                    for word in words:
-                        if word not in st.session_state.keyword_dict[new_cat]:
-                            st.session_state.keyword_dict[new_cat].append(word)
+            new_cats = edited_df["Category"]
+            old_cats = df["Category"].reindex(edited_df.index)
+            mask = (
+                new_cats.notna() & edited_df["_name_key"].notna()
+                & (new_cats != old_cats)
+                & new_cats.astype(str).str.strip().astype(bool)
+            )
+            changed_rows = edited_df.loc[mask, ["_name_key", "Category"]]
+            changed = not changed_rows.empty
+            keywords_added = False
 
-            # If any changes, save mapping and re-categorize all rows
             if changed:
-                save_name_category_map(st.session_state.name_to_category)
-                df = categorize_transactions(debits_df, st.session_state.keyword_dict, st.session_state.name_to_category)
+                # Learn from full name
+                st.session_state.name_to_category.update(
+                    zip(changed_rows["_name_key"], changed_rows["Category"])
+                )
+
+                # Add name tokens to keyword dict, creating the category if missing
+                for new_cat, names in changed_rows.groupby("Category", sort=False)["_name_key"]:
+                    keywords = st.session_state.keyword_dict.setdefault(new_cat, set())
+                    new_words = set(" ".join(names).split()) - keywords
+                    if new_words:
+                        keywords |= new_words
+                        keywords_added = True
+
+            # If any changes, save mapping and re-categorize affected rows
+            if changed:
+                queue_name_category_updates(zip(changed_rows["_name_key"], changed_rows["Category"]))
+                if keywords_added:
+                    # New keywords can match any name, so rebuild the index and re-categorize everything
+                    st.session_state.keyword_to_category = build_keyword_index(st.session_state.keyword_dict)
+                    df = categorize_transactions(debits_df, st.session_state.keyword_to_category, st.session_state.name_to_category)
+                else:
+                    # Only rows sharing a newly learned name can change
+                    affected = debits_df["_name_key"].isin(set(changed_rows["_name_key"]))
+                    debits_df.loc[affected, "Category"] = debits_df.loc[affected, "_name_key"].map(st.session_state.name_to_category)
+                    df = debits_df
                 edited_df = df.copy()
 
+            # Compact dtypes for aggregation; the editor keeps object columns so new categories can be typed
+            analysis_df = edited_df.astype({"Category": "category", "Debit/Credit": "category"})
+
             # Expense Summary Table
             st.markdown("### 📌 Expense Summary")
-            summary = edited_df.groupby("Category")["Amount"].sum().reset_index().sort_values(by="Amount", ascending=False)
+            summary = analysis_df.groupby("Category", observed=True)["Amount"].sum().reset_index().sort_values(by="Amount", ascending=False)
             st.dataframe(summary, use_container_width=True)
 
             # Visual Insights
@@ -303,7 +597,7 @@ def main():
             # CSV Download
             st.download_button(
                 "⬇️ Download Categorized CSV",
-                data=edited_df.to_csv(index=False),
+                data=export_csv_bytes(frame_content_key(edited_df), edited_df),
                 file_name="categorized_phonepe.csv",
                 mime="text/csv"
             )
@@ -314,7 +608,7 @@ def main():
             if st.button("Ask", key="ask_btn") and user_query.strip():
                 with st.spinner("Thinking..."):
                     try:
-                        answer = answer_nlp_question(edited_df, user_query)
+                        answer = answer_nlp_question(analysis_df, user_query)
                         st.success(answer)
                     except Exception as e:
                         st.error(f"Sorry, couldn't answer your question. Try rephrasing or ask something else. Error: {str(e)}")